@@ -4,15 +4,15 @@ import argparse
 import http.client
 import json
 import os
+import re
+import shutil
 import subprocess
 import sys
-from typing import Callable, Dict, Any, List, Tuple, Final, Iterable
-from urllib.parse import urlparse, parse_qs
-
-import leancloud
-from MusicBoxApi import api
-from MusicBoxApi.api import TooManyTracksException
-from pypinyin import lazy_pinyin
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from importlib import import_module
+from typing import Callable, Dict, Any, List, Tuple, Final, Iterable, Optional, Pattern
+from urllib.parse import urlencode
 
 from nonpythonic import fn, for_each, catch
 
@@ -20,45 +20,113 @@ Track = Dict[str, Any]
 Playlist = List[Dict[str, Any]]
 
 # Windows workaround
-print_utf8: Final[Callable[[str], None]] = lambda text, /: fn(sys.stdout.buffer.write(text.encode('utf-8')))
-skip: Final[Callable[[str, int, str], None]] = lambda track_name, track_id, msg = "SKIP", /: print_utf8(
+print_utf8: Final[Callable[[str], None]] = lambda text, /: fn(
+    # Keep the order of text already queued by print().
+    sys.stdout.flush(),
+    sys.stdout.buffer.write(text.encode('utf-8')))
+skip_line: Final[Callable[[str, int, str], str]] = lambda track_name, track_id, msg = "SKIP", /: (
     f"{msg} {track_name} http://music.163.com/#/song?id={track_id}\n")
-load_keys: Final[Callable[[], Tuple[str, str]]] = lambda: (
+skip: Final[Callable[[str, int, str], None]] = lambda track_name, track_id, msg = "SKIP", /: print_utf8(
+    skip_line(track_name, track_id, msg))
+# One write for the whole list instead of one per track.
+skip_all: Final[Callable[[Iterable[Tuple[str, int]], str], None]] = lambda tracks, msg = "SKIP", /: print_utf8(
+    "".join(skip_line(track_name, track_id, msg) for track_name, track_id in tracks))
+load_keys: Final[Callable[[], Tuple[str, str]]] = lru_cache(maxsize=1)(lambda: (
     os.environ['LEANCLOUD_APP_ID'],
-    os.environ['LEANCLOUD_APP_KEY'])
-prepare_download: Final[Callable[[Playlist], Tuple[List[Tuple[str, int]], List[str]]]] = lambda playlist, /: fn(
-    leancloud.init(*load_keys()),
-    track_id_list := [str(track["id"]) for track in playlist],
-    query := leancloud.Object.extend('Track').query.contained_in('objectId', track_id_list).limit(1000).select("name"),
-    ret=(sorted(
-        [(track.get("name"), int(track.id)) for track in query.find()],
-        key=lambda t: lazy_pinyin(t[0])[0].lower()), track_id_list))
-download_track: Final[Callable[[int, bool], None]] = lambda track_id, dry_run: not dry_run and fn(
-    subprocess.run(["ncm", "-s", str(track_id)]))
-parse_playlist_url: Final[Callable[[str], int]] = lambda string, /: fn(
-    # NetEase cloud music uses pseudo url queries.
-    url_string := string.replace('/#', ''),
-    url := urlparse(url_string),
-    queries := parse_qs(url.query),
-    ret=int(queries['id'][0]))
-playlist_id: Final[Callable[[str], int]] = lambda string, /: parse_playlist_url(string) if "/#" in string else int(string)
-save_meta_info: Final[Callable[[Iterable[Track]], None]] = lambda tracks, /: fn(
-    subdomain := os.environ['LEANCLOUD_APP_ID'][0:8].lower(),
-    conn := http.client.HTTPSConnection(f"{subdomain}.api.lncldglobal.com"),
-    headers := {
-        'x-lc-id': load_keys()[0],
-        'x-lc-key': load_keys()[1],
-        'content-type': "application/json"
+    os.environ['LEANCLOUD_APP_KEY']))
+api_host: Final[Callable[[], str]] = lambda: f"{load_keys()[0][0:8].lower()}.api.lncldglobal.com"
+api_headers: Final[Callable[[], Dict[str, str]]] = lambda: {
+    'x-lc-id': load_keys()[0],
+    'x-lc-key': load_keys()[1],
+    'content-type': "application/json"
+}
+# One keep-alive connection shared by the query and the meta info upload.
+api_connection: Final[Callable[[], http.client.HTTPSConnection]] = lru_cache(maxsize=1)(
+    lambda: http.client.HTTPSConnection(api_host()))
+prepare_download: Final[Callable[[Playlist], List[Tuple[str, int]]]] = lambda playlist, /: fn(
+    # Imported on first use to keep `fm163 -h` fast.
+    lazy_pinyin := import_module('pypinyin').lazy_pinyin,
+    conn := api_connection(),
+    # objectId is the track id as a string; only stringify it for the query.
+    conn.request("GET", "/1.1/classes/Track?" + urlencode({
+        "where": json.dumps({"objectId": {"$in": [str(track["id"]) for track in playlist]}}, separators=(',', ':')),
+        "keys": "name",
+        "limit": 1000,
+    }), headers=api_headers()),
+    response := conn.getresponse(),
+    body := response.read(),
+    response.status == 200 or fn(
+        sys.stderr.write(f"Failed to query saved tracks: {response.status} {response.reason}\n"),
+        sys.stderr.write(body.decode('utf-8', 'replace')),
+        sys.exit(1)),
+    ret=sorted(
+        [(track.get("name"), int(track["objectId"])) for track in json.loads(body)["results"]],
+        key=lambda t: lazy_pinyin(t[0])[0].lower()))
+# Returns the (name, id) of a track ncm failed to fetch, None on success.
+download_track: Final[Callable[[Track], Optional[Tuple[str, int]]]] = lambda track, /: catch(
+    lambda: subprocess.run(["ncm", "-s", str(track["id"])]),
+    {
+        FileNotFoundError: lambda e: (track['name'], track['id']),
     },
-    for_each(tracks, lambda track: fn(
-        track.setdefault("objectId", str(track["id"])),
-        conn.request("POST", "/1.1/classes/Track", json.dumps(track), headers),
+    lambda completed: None if completed.returncode == 0 else (track['name'], track['id']))
+download_tracks: Final[Callable[[Iterable[Track], int, bool], None]] = lambda tracks, jobs, dry_run, /: not dry_run and fn(
+    # ncm is network bound, so running several instances overlaps their waits.
+    executor := ThreadPoolExecutor(max_workers=jobs),
+    failed := [track for track in executor.map(download_track, tracks) if track is not None],
+    executor.shutdown(),
+    # Meta info is saved either way, so name the tracks that were never fetched.
+    # Printed once the workers are done, away from ncm's progress output.
+    skip_all(failed, "Failed to download"))
+# NetEase cloud music uses pseudo url queries, e.g. https://music.163.com/#/playlist?id=42
+playlist_url_id: Final[Pattern[str]] = re.compile(r'[?&]id=(\d+)')
+playlist_id: Final[Callable[[str], int]] = lambda string, /: fn(
+    match := playlist_url_id.search(string),
+    ret=int(match.group(1)) if match else int(string))
+
+
+def positive_int(string: str) -> int:
+    # A def, since a lambda cannot raise the ArgumentTypeError argparse reports.
+    value: int = int(string)
+    if value < 1:
+        raise argparse.ArgumentTypeError(f"{string} is not a positive integer")
+    return value
+
+
+# LeanCloud accepts at most 50 operations in one batch request.
+batch_size: Final[int] = 50
+batches: Final[Callable[[List[Track], int], Iterable[List[Track]]]] = lambda tracks, size, /: (
+    tracks[i:i + size] for i in range(0, len(tracks), size))
+save_meta_info: Final[Callable[[Iterable[Track]], None]] = lambda tracks, /: fn(
+    conn := api_connection(),
+    headers := api_headers(),
+    for_each(batches(list(tracks), batch_size), lambda batch: fn(
+        # Raw UTF-8 is about half the size of \uXXXX escapes for CJK names.
+        conn.request("POST", "/1.1/batch", json.dumps({"requests": [{
+            "method": "POST",
+            "path": "/1.1/classes/Track",
+            "body": {"objectId": str(track["id"]), **track},
+        } for track in batch]}, ensure_ascii=False, separators=(',', ':')).encode('utf-8'), headers),
         response := conn.getresponse(),
-        response.read() if response.status == 201 else fn(
-            skip(track['name'], track['id'], "Failed to save meta info for"),
+        body := response.read(),
+        for_each(zip(batch, json.loads(body)), lambda result: "error" in result[1] and fn(
+            skip(result[0]['name'], result[0]['id'], "Failed to save meta info for"),
+            print(result[1]["error"]))) if response.status == 200 else fn(
+            for_each(batch, lambda track: skip(track['name'], track['id'], "Failed to save meta info for")),
             print(response.status, response.reason),
-            print(response.read())))),
-    conn.close())
+            print(body)))))
+
+
+def save_and_download(tracks: List[Track], jobs: int, dry_run: bool) -> None:
+    # Upload meta info while ncm is downloading. A def for with/finally:
+    # the upload is joined and the connection closed even if a download raises.
+    try:
+        with ThreadPoolExecutor(max_workers=1) as uploader:
+            uploaded = uploader.submit(save_meta_info, tracks)
+            download_tracks(tracks, jobs, dry_run)
+            uploaded.result()
+    finally:
+        api_connection().close()
+
 
 main: Final[Callable[[], None]] = lambda: fn(
     argument_parser := argparse.ArgumentParser(prog='fm163'),
@@ -67,30 +135,39 @@ main: Final[Callable[[], None]] = lambda: fn(
     mutually_exclusive_group.add_argument(
         '-D', action='store_true',
         help='dry run (record history and meta data, without downloading)'),
+    argument_parser.add_argument(
+        '-j', '--jobs', type=positive_int, default=1,
+        help='number of tracks to download in parallel (default: 1)'),
     arguments := argument_parser.parse_args(),
+    arguments.playlist_id >= 0 or fn(
+        print("Run `fm163 -h` for help info."),
+        sys.exit(getattr(os, 'EX_USAGE', 64))),
+    # Check before anything is recorded, otherwise every track is saved but never fetched.
+    arguments.D or shutil.which("ncm") or fn(
+        sys.stderr.write("ncm not found in PATH; install it or use -D for a dry run.\n"),
+        sys.exit(getattr(os, 'EX_UNAVAILABLE', 69))),
+    api := import_module('MusicBoxApi.api'),
     catch(
         lambda: fn(
             netease := api.NetEase(),
             playlist := netease.playlist_detail(arguments.playlist_id),
-            ret=prepare_download(playlist) + (playlist,)),
+            ret=(prepare_download(playlist), playlist)),
         {
-            TooManyTracksException: lambda e: fn(
+            api.TooManyTracksException: lambda e: fn(
                 sys.stderr.write(str(e)),
                 sys.exit(1)),
         },
         lambda values: fn(
             skipped := values[0],
-            track_id_list := values[1],
-            playlist := values[2],
+            playlist := values[1],
+            skipped_id := {track_id for _, track_id in skipped},
+            # Keyed by id: a playlist may list a track twice, and a second create for
+            # the same objectId in one batch would fail (and ncm would race itself).
+            to_download := list({track["id"]: track for track in playlist if track["id"] not in skipped_id}.values()),
             ret=fn(
                 print("\nSkipped all tracks in the playlist."),
-                sys.exit(0)) if len(skipped) == len(track_id_list) else fn(
+                sys.exit(0)) if not to_download else fn(
                 print(f"\nSkipped {len(skipped)} tracks in the playlist."),
-                for_each(skipped, lambda skipped_track: skip(skipped_track[0], skipped_track[1])),
-                skipped_id := {elem[1] for elem in skipped},
-                to_download_id := {int(track_id) for track_id in track_id_list} - skipped_id,
-                to_download := filter(lambda track: track["id"] in to_download_id, playlist),
-                save_meta_info(to_download))) if arguments.playlist_id >= 0 else fn(
-                    print("Run `fm163 -h` for help info."),
-                    sys.exit(getattr(os, 'EX_USAGE', 64)))))
+                skip_all(skipped),
+                save_and_download(to_download, arguments.jobs, arguments.D)))))
 __name__ == "__main__" and main()